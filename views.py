@@ -1,20 +1,204 @@
-from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseBadRequest, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 
 from linebot import LineBotApi, WebhookParser, WebhookHandler
-from linebot.exceptions import InvalidSignatureError, LineBotApiError
-from linebot.models import MessageEvent, TextMessage, StickerMessage, ImageMessage, VideoMessage, AudioMessage, FileMessage
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.models import SourceGroup, MessageEvent, TextMessage, StickerMessage, ImageMessage, VideoMessage, AudioMessage, FileMessage
 
-import functools
-import operator
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
 import mimetypes
 import logging
 import json
+import orjson
+import functools
+import contextlib
+import os
+import threading
+import hmac
+import hashlib
+import base64
+from concurrent.futures import ThreadPoolExecutor
+
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 
 logger = logging.getLogger(__name__)
 
+def _make_session(retries):
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries))
+    return session
+
+# shared sessions so that keep-alive connections to Discord are reused across events.
+# Webhook posts aren't idempotent, so only responses that say the message wasn't
+# accepted (rate limited or unavailable, honoring Retry-After) are retried; a 500
+# may come after Discord already posted it. Streamed uploads can't be sent twice,
+# so for them only failed connects are retried. The final response is returned
+# rather than raised, so its error body gets logged
+_session = _make_session(Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=[429, 503],
+    allowed_methods=['POST'],
+    raise_on_status=False
+))
+_upload_session = _make_session(Retry(total=3, backoff_factor=0.3))
+
+# the Line SDK opens a new connection per call by default, give it a session too
+_line_session = _make_session(Retry(total=3, backoff_factor=0.3))
+
+# caches for Line API lookups, so chatty users don't trigger a profile fetch per message.
+# Profiles are keyed by (group_id, user_id), so a membership check also warms the overrides.
+# Membership is answered from either cache, so both share one TTL: a user who left a
+# listening group can still broadcast for up to 60s, and a new member waits as long
+_cache_ttl = 60
+_profile_cache = TTLCache(maxsize=512, ttl=_cache_ttl)
+_membership_cache = TTLCache(maxsize=512, ttl=_cache_ttl)
+
+# key for verifying webhook signatures
+_channel_secret = settings.LINE['secret'].encode('utf-8')
+
+# (connect, read) timeouts, so a hung Discord endpoint doesn't stall the worker
+_timeout = (3, 10)
+
+# events are forwarded in the background so Line gets its response right away.
+# The queue lives in this process only: events still queued when the process
+# restarts or is recycled are lost, and Line doesn't redeliver acknowledged webhooks
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='carbot')
+
+# webhooks beyond this many queued or running are rejected rather than queued without bound
+_max_pending = 64
+_pending = threading.BoundedSemaphore(_max_pending)
+
+# separate pool for lookups issued from within event handlers,
+# so they can't be starved by the handlers waiting on them
+_lookup_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='carbot-lookup')
+
+@functools.lru_cache(maxsize=128)
+def _get_ext(mimetype):
+    """ Guesses a file extension Discord can recognize from a mimetype. """
+    guessed_ext = mimetypes.guess_extension(mimetype)
+    if guessed_ext is None:
+        if mimetype.startswith('audio/'):
+            # huge hack, if type is known to be audio then use mp3,
+            # so that discord shows an audio player
+            guessed_ext = '.mp3'
+        else:
+            logger.info('Mimetype {} did not have a guessed extension'.format(mimetype))
+            guessed_ext = ''
+
+    if guessed_ext == '.jpe':
+        # I don't know why jpe sometimes comes up... Discord can't recognize this.
+        # Just use jpg in that case
+        guessed_ext = '.jpg'
+
+    return guessed_ext
+
+class _SessionHttpClient(RequestsHttpClient):
+    """ Line SDK http client that keeps its connections alive in a shared session.
+
+        LineBotApi instantiates its http_client class itself, so the session is module level.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.session = _line_session
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(
+            url, headers=headers, data=data, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(
+            url, headers=headers, data=data, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(
+            url, headers=headers, data=data, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+# pid of the process whose connections were prewarmed, so a forked worker warms its own
+_prewarmed_pid = None
+_prewarm_lock = threading.Lock()
+
+def _prewarm_connections():
+    """ Opens connections to Discord in the background, once per serving process.
+
+        Runs on the first webhook rather than at startup, so management commands
+        don't reach out to Discord, and a preforking server's workers don't share
+        sockets opened before the fork. The first event's Line download then
+        overlaps with the Discord handshakes. Line isn't prewarmed: its first calls
+        come from that same event and would race any prewarm on another connection.
+    """
+    global _prewarmed_pid
+    with _prewarm_lock:
+        if _prewarmed_pid == os.getpid():
+            return
+        _prewarmed_pid = os.getpid()
+
+    def head(session, url):
+        try:
+            session.head(url, timeout=2)
+        except requests.RequestException as e:
+            logger.info('Unable to prewarm connection to {}: {}'.format(url, str(e)))
+
+    for session in (_session, _upload_session):
+        _executor.submit(head, session, 'https://discordapp.com/api/webhooks/')
+
+class _MultipartStream:
+    """ A multipart/form-data body that forwards its file part chunk by chunk.
+
+        requests reads files whole when encoding multipart bodies, so the body is
+        assembled here instead, letting the Line download feed the Discord upload
+        without holding the attachment in memory.
+    """
+    def __init__(self, fields, filename, chunks, file_length):
+        self.boundary = choose_boundary()
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+
+        head = []
+        for name, value in fields.items():
+            if value is None:
+                continue
+            if not isinstance(value, bytes):
+                value = str(value).encode('utf-8')
+            head.append(self._part_header(RequestField(name, value)) + value + b'\r\n')
+        head.append(self._part_header(RequestField('file', None, filename=filename)))
+
+        self._head = b''.join(head)
+        self._tail = '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')
+        self._chunks = chunks
+        self._length = len(self._head) + file_length + len(self._tail)
+
+    def _part_header(self, field):
+        field.make_multipart()
+        return '--{}\r\n{}'.format(self.boundary, field.render_headers()).encode('utf-8')
+
+    def __len__(self):
+        # lets requests send a Content-Length rather than a chunked body
+        return self._length
+
+    def __iter__(self):
+        yield self._head
+        yield from self._chunks
+        yield self._tail
+
 class DiscordCarbot:
     repeat_hook_url = (
         'https://discordapp.com/api/webhooks/{repeat_webhook_id}/{repeat_webhook_token}'
@@ -30,35 +214,51 @@ class DiscordCarbot:
     def send_message(hook_url, content=None, file=None, embeds=None, username=None, avatar_url=None, payload_json=None, tts=False):
         """ Sends a message to Discord. Passes thru Discord API.
         
-            Refer to Discord API documentation.
+            Refer to Discord API documentation. file is a tuple of
+            (filename, iterable of byte chunks, total length in bytes).
         """
-        data = locals()
-        # file needs to be separately handled,
-        # remove it from data dict
-        del data['file']
-
-        response = requests.post(hook_url, 
-                                 json=data, # when there is embeds (line stickers), must use json
-                                 data=data if file is not None else None, # when there is file, json can't be used, fallback to use form data
-                                 files={ 'file' : file } if file is not None else None
-                                 )
+        # file is separately handled, so it's not part of the data dict
+        data = {
+            'content'      : content,
+            'embeds'       : embeds,
+            'username'     : username,
+            'avatar_url'   : avatar_url,
+            'payload_json' : payload_json,
+            'tts'          : tts,
+        }
+        # leave out unset fields rather than sending them as nulls
+        data = { key : value for key, value in data.items() if value is not None }
 
         try:
+            if file is None:
+                # when there is embeds (line stickers), must use json
+                response = _session.post(hook_url,
+                                         data=orjson.dumps(data),
+                                         headers={ 'Content-Type' : 'application/json' },
+                                         timeout=_timeout
+                                         )
+            else:
+                # when there is file, json can't be used, fallback to use form data
+                body = _MultipartStream(data, *file)
+                response = _upload_session.post(hook_url,
+                                                data=body,
+                                                headers={ 'Content-Type' : body.content_type },
+                                                timeout=_timeout
+                                                )
             response.raise_for_status()
-        except:
-            requests.post(hook_url,
-                          data=dict(content='Unable to forward a message from Line.')
-                          )
-            logger.error('Unable to forward a message from Line. Locals: {}, response: {}'.format(str(locals()), str(response.text)))
+        except requests.RequestException as e:
+            logger.error('Unable to forward a message from Line. Data: {}, file: {}, error: {}, response: {}'.format(
+                str(data), str(file), str(e), e.response.text if e.response is not None else None
+            ))
 
 class LineCarbot:
     handler = WebhookHandler(settings.LINE['secret'])
-    api = LineBotApi(settings.LINE['token'])
-    listening_groups = [ settings.LINE['capture_group_id'] ]
+    api = LineBotApi(settings.LINE['token'], http_client=_SessionHttpClient)
+    listening_groups = frozenset([ settings.LINE['capture_group_id'] ])
 
     @handler.add(MessageEvent, message=TextMessage)
     def handle_text_message(event):
-        if hasattr(event.source, 'group_id'):
+        if isinstance(event.source, SourceGroup):
             if event.source.group_id in LineCarbot.listening_groups:
                 DiscordCarbot.send_message(
                     DiscordCarbot.repeat_hook_url,
@@ -76,7 +276,7 @@ class LineCarbot:
 
     @handler.add(MessageEvent, message=StickerMessage)
     def handle_sticker_message(event):
-        if hasattr(event.source, 'group_id'):
+        if isinstance(event.source, SourceGroup):
             if event.source.group_id in LineCarbot.listening_groups:
                 DiscordCarbot.send_message(
                     DiscordCarbot.repeat_hook_url,
@@ -89,24 +289,25 @@ class LineCarbot:
             logger.info('Sticker message ignored as message source {} is not from listening groups.'.format(event.source))
 
 
-    @handler.add(MessageEvent, message=ImageMessage)
-    @handler.add(MessageEvent, message=VideoMessage)
-    @handler.add(MessageEvent, message=AudioMessage)
-    @handler.add(MessageEvent, message=FileMessage)
+    @handler.add(MessageEvent, message=(ImageMessage, VideoMessage, AudioMessage, FileMessage))
     def handle_file_message(event):
-        if hasattr(event.source, 'group_id'):
+        if isinstance(event.source, SourceGroup):
             if event.source.group_id in LineCarbot.listening_groups:
-                DiscordCarbot.send_message(
-                    DiscordCarbot.repeat_hook_url,
-                    **LineCarbot.get_file(event.message.id),
-                    **LineCarbot.get_user_overrides(event.source.user_id)
-                )
+                # look up the sender while the content is being requested from Line
+                overrides = _lookup_executor.submit(LineCarbot.get_user_overrides, event.source.user_id)
+                with LineCarbot.get_file(event.message.id) as file:
+                    DiscordCarbot.send_message(
+                        DiscordCarbot.repeat_hook_url,
+                        **file,
+                        **overrides.result()
+                    )
         elif LineCarbot.user_in_listening_group(event.source.user_id):
             logger.info('User {} sent a private file message.'.format(event.source))
-            DiscordCarbot.send_message(
-                DiscordCarbot.broadcast_hook_url,
-                **LineCarbot.get_file(event.message.id),
-            )
+            with LineCarbot.get_file(event.message.id) as file:
+                DiscordCarbot.send_message(
+                    DiscordCarbot.broadcast_hook_url,
+                    **file,
+                )
         else:
             logger.info('File message ignored as message source {} is not from listening groups.'.format(event.source))
 
@@ -116,12 +317,13 @@ class LineCarbot:
 
 
     @staticmethod
+    @cached(_membership_cache, key=lambda user_id: hashkey(user_id), lock=threading.Lock())
     def user_in_listening_group(user_id):
         for group_id in LineCarbot.listening_groups:
             try:
                 # try to get the member profile,
                 # if successful then member is in one of the listening groups
-                profile = LineCarbot.api.get_group_member_profile(group_id, user_id)
+                profile = LineCarbot.get_group_member_profile(group_id, user_id)
                 logger.info('User: {}'.format(profile.display_name))
                 return True
             except LineBotApiError:
@@ -135,46 +337,44 @@ class LineCarbot:
         return { 
             'embeds' : [{
                 'image' : {
-                    'url' : 'https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/{platform}/sticker.png'.format(
-                        platform='android',
-                        sticker_id=sticker_message.sticker_id
-                    )
+                    'url' : f'https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_message.sticker_id}/android/sticker.png'
                 }
             }]
         }
 
     @staticmethod
+    @contextlib.contextmanager
     def get_file(message_id):
         """ Retrieves file content given message_id. 
         
-            Converts and returns a dictionary ready to be passed to Discord API. 
+            Converts and yields a dictionary ready to be passed to Discord API.
+            The content is streamed from Line, so its response is closed on exit.
         """
         message_content = LineCarbot.api.get_message_content(message_id)
+        try:
+            filename = 'attachment' + _get_ext(message_content.content_type);
+
+            headers = message_content.response.headers
+            if 'Content-Length' in headers and 'Content-Encoding' not in headers:
+                chunks = message_content.iter_content(chunk_size=1 << 16)
+                length = int(headers['Content-Length'])
+            else:
+                # the upload size must be known up front, so buffer the content when Line doesn't tell
+                content = b''.join(message_content.iter_content(chunk_size=1 << 16))
+                chunks, length = (content,), len(content)
+
+            logger.info('Sending {} with message_id={}'.format(filename, str(message_id)))
+            yield {
+                'file' : (filename, chunks, length),
+            }
+        finally:
+            message_content.response.response.close()
 
-        def get_ext(mimetype):
-            guessed_ext = mimetypes.guess_extension(mimetype)
-            if guessed_ext is None:
-                if 'audio/' in mimetype:
-                    # huge hack, if type is known to be audio then use mp3,
-                    # so that discord shows an audio player
-                    guessed_ext = '.mp3'
-                else:
-                    logger.info('Mimetype {} did not have a guessed extension'.format(mimetype))
-                    guessed_ext = ''
-
-            if guessed_ext == '.jpe':
-                # I don't know why jpe sometimes comes up... Discord can't recognize this.
-                # Just use jpg in that case
-                guessed_ext = '.jpg'
-
-            return guessed_ext
-
-        filename = 'attachment' + get_ext(message_content.content_type);
-
-        logger.info('Sending {} with message_id={}'.format(filename, str(message_id)))
-        return {
-            'file' : (filename, functools.reduce(operator.add, message_content.iter_content())),
-        }
+    @staticmethod
+    @cached(_profile_cache, key=lambda group_id, user_id: hashkey(group_id, user_id), lock=threading.Lock())
+    def get_group_member_profile(group_id, user_id):
+        """ Fetches a group member's profile, shared by membership checks and user overrides. """
+        return LineCarbot.api.get_group_member_profile(group_id, user_id)
 
     @staticmethod
     def get_user_overrides(user_id):
@@ -191,7 +391,7 @@ class LineCarbot:
             logger.info('Cannot fetch user_id, user may not have added any bot as a friend.')
             return {}
 
-        profile = LineCarbot.api.get_group_member_profile(settings.LINE['capture_group_id'], user_id)
+        profile = LineCarbot.get_group_member_profile(settings.LINE['capture_group_id'], user_id)
         
         logger.info('User {} has avatar url {}'.format(profile.display_name, profile.picture_url))
 
@@ -202,20 +402,39 @@ class LineCarbot:
             'avatar_url' : profile.picture_url,
         }
 
+def _signature_valid(body, signature):
+    digest = hmac.new(_channel_secret, body, hashlib.sha256).digest()
+    return hmac.compare_digest(signature.encode('utf-8'), base64.b64encode(digest))
+
+def _log_failure(future):
+    _pending.release()
+    exception = future.exception()
+    if exception is not None:
+        logger.error('Unable to handle events from Line.', exc_info=exception)
+
 @csrf_exempt
 def endpoint(request):
     if request.method != 'POST':
         return HttpResponseNotAllowed(['POST'])
 
     signature = request.META['HTTP_X_LINE_SIGNATURE']
-    body = request.body.decode('utf-8')
 
-    try:
-        LineCarbot.handler.handle(body, signature)
-    except InvalidSignatureError:
+    # verify over the raw bytes, so a spoofed request is rejected before decoding its body
+    if not _signature_valid(request.body, signature):
         return HttpResponseForbidden()
-    except LineBotApiError:
-        return HttpResponseBadRequest()
+
+    body = request.body.decode('utf-8')
+
+    if not _pending.acquire(blocking=False):
+        logger.error('Dropping a webhook from Line, {} are already pending.'.format(_max_pending))
+        return HttpResponse(status=503)
+
+    _prewarm_connections()
+
+    # the Line download and Discord delivery can take a while,
+    # acknowledge the webhook now and forward the events in the background
+    _executor.submit(LineCarbot.handler.handle, body, signature).add_done_callback(_log_failure)
 
     return HttpResponse()
 
+